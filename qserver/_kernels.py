@@ -0,0 +1,124 @@
+""" Numba-compiled gate kernels, used by QiskitSimulator when numba
+is installed. The kernels work on the flattened state vector, where
+a qubit is selected by the bit `mask` of the amplitude index and the
+quantum controls by the bits of `cmask` """
+from typing import List
+import numpy as np
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+# states smaller than this are not worth spreading over threads
+PARALLEL_THRESHOLD = 1 << 14
+
+
+def _apply_u(state, u00, u01, u10, u11, mask, cmask):
+    for k in prange(state.size // 2):
+        # inserting a 0 at the target bit of k
+        i = ((k & ~(mask - 1)) << 1) | (k & (mask - 1))
+        if i & cmask == cmask:
+            j = i | mask
+            a = state[i]
+            b = state[j]
+            state[i] = u00 * a + u01 * b
+            state[j] = u10 * a + u11 * b
+
+
+def _apply_diag(state, d0, d1, mask, cmask):
+    for i in prange(state.size):
+        if i & cmask == cmask:
+            if i & mask:
+                state[i] *= d1
+            else:
+                state[i] *= d0
+
+
+def _apply_phase(state, d1, mask, cmask):
+    # only touching the half of the state where the target bit is 1
+    for k in prange(state.size // 2):
+        j = ((k & ~(mask - 1)) << 1) | (k & (mask - 1)) | mask
+        if j & cmask == cmask:
+            state[j] *= d1
+
+
+def _apply_swap(state, s0, s1, mask, cmask):
+    for k in prange(state.size // 2):
+        i = ((k & ~(mask - 1)) << 1) | (k & (mask - 1))
+        if i & cmask == cmask:
+            j = i | mask
+            a = state[i]
+            state[i] = s0 * state[j]
+            state[j] = s1 * a
+
+
+# number of amplitude groups handled by each iteration of the dense
+# kernel's parallel loop, which share one temporary buffer
+DENSE_BLOCK = 1024
+
+
+def _apply_dense(state, U, masks, offsets, cmask):
+    groups = state.size >> masks.size
+    for block in prange((groups + DENSE_BLOCK - 1) // DENSE_BLOCK):
+        amps = np.empty(offsets.size, dtype=state.dtype)
+        for g in range(block * DENSE_BLOCK, min(groups, (block + 1) * DENSE_BLOCK)):
+            # inserting 0s at the target bits of g (masks are sorted)
+            i = g
+            for m in masks:
+                i = ((i & ~(m - 1)) << 1) | (i & (m - 1))
+            if i & cmask == cmask:
+                for c in range(offsets.size):
+                    amps[c] = state[i + offsets[c]]
+                for r in range(offsets.size):
+                    acc = U[r, 0] * amps[0]
+                    for c in range(1, offsets.size):
+                        acc += U[r, c] * amps[c]
+                    state[i + offsets[r]] = acc
+
+
+if HAVE_NUMBA:
+    # compiled in a parallel and a serial version each, numba
+    # specializes them on the state's dtype by itself
+    _KERNELS = {
+        parallel: {
+            'u': njit(parallel=parallel, fastmath=True, cache=True)(_apply_u),
+            'diag': njit(parallel=parallel, fastmath=True, cache=True)(_apply_diag),
+            'phase': njit(parallel=parallel, fastmath=True, cache=True)(_apply_phase),
+            'swap': njit(parallel=parallel, fastmath=True, cache=True)(_apply_swap),
+            'dense': njit(parallel=parallel, fastmath=True, cache=True)(_apply_dense),
+        }
+        for parallel in (False, True)
+    }
+
+
+def apply_1q(state: np.ndarray, U: np.ndarray, mask: int, cmask: int):
+    """ Apply the 2x2 matrix U in place to the flattened state """
+    kernels = _KERNELS[state.size >= PARALLEL_THRESHOLD]
+    if U[0, 1] == 0 and U[1, 0] == 0:
+        if U[0, 0] == 1:
+            # phase gates (Z, S, T, CZ) leave the 0 half alone
+            kernels['phase'](state, U[1, 1], mask, cmask)
+        else:
+            kernels['diag'](state, U[0, 0], U[1, 1], mask, cmask)
+    elif U[0, 0] == 0 and U[1, 1] == 0:
+        kernels['swap'](state, U[0, 1], U[1, 0], mask, cmask)
+    else:
+        kernels['u'](state, U[0, 0], U[0, 1], U[1, 0], U[1, 1], mask, cmask)
+
+
+def apply_kq(state: np.ndarray, U: np.ndarray, masks: List[int], cmask: int):
+    """ Apply the 2^k x 2^k matrix U in place to the flattened state,
+    masks[0] selecting the most significant qubit of U """
+    k = len(masks)
+    offsets = np.zeros(1 << k, dtype=np.int64)
+    for j in range(1 << k):
+        for b in range(k):
+            if j >> (k - 1 - b) & 1:
+                offsets[j] += masks[b]
+
+    kernels = _KERNELS[state.size >= PARALLEL_THRESHOLD]
+    kernels['dense'](state, np.ascontiguousarray(U), np.array(sorted(masks), dtype=np.int64),
+                     offsets, cmask)
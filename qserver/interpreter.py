@@ -70,10 +70,10 @@ class Null(Result):
 
 
 class Interpreter:
-    def __init__(self, sim_method: str = 'cirq'):
+    def __init__(self, sim_method: str = 'cirq', precision: str = 'single'):
         match sim_method:
             case 'qiskit':
-                self.sim = QiskitSimulator()
+                self.sim = QiskitSimulator(precision=precision)
             case 'cirq':
                 self.sim = CirqSimulator()
             case _:
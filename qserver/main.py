@@ -10,10 +10,12 @@ def main():
     parser.add_argument('-n', '--max_connections', type=int, default=30)
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('-s', '--sim_method', type=str, default='cirq')
+    parser.add_argument('--precision', type=str, default='single', choices=['single', 'double'])
     args = parser.parse_args()
 
     # starting server
-    Server(args.port, args.max_connections, args.verbose, sim_method=args.sim_method).run()
+    Server(args.port, args.max_connections, args.verbose, sim_method=args.sim_method,
+           precision=args.precision).run()
 
 
 if __name__ == '__main__':
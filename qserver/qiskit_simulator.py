@@ -1,14 +1,55 @@
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Optional, Tuple, Callable
+from functools import lru_cache
 from abc import ABC
 from dataclasses import dataclass
 import numpy as np
-from qiskit import QuantumCircuit, qasm3
+from qiskit import QuantumCircuit, qasm3, transpile
 from qiskit_aer import AerSimulator
-from qiskit.quantum_info import partial_trace
-from qiskit.quantum_info.states.statevector import Statevector
-from qiskit.circuit.library import XGate, HGate, YGate, ZGate, TGate, SGate, CXGate, CCXGate, RZGate, DiagonalGate
+from qiskit.circuit import Gate
+from qiskit.exceptions import MissingOptionalLibraryError
+from qiskit.quantum_info import StabilizerState
+from qiskit.synthesis import synth_circuit_from_stabilizers
+from qiskit.circuit.library import XGate, HGate, YGate, ZGate, TGate, TdgGate, SGate, SdgGate, \
+    RZGate, DiagonalGate, CXGate, CYGate, CZGate, CCXGate, CRZGate
 
 from .simulator import *
+from . import _kernels
+
+try:
+    import cupy as cp
+except ImportError:
+    cp = None
+
+
+# number of queued gates at which the queue is flushed,
+# keeping the memory held by pending gates bounded
+MAX_PENDING_GATES = 128
+
+# maximum number of qubits a fused gate may act on
+FUSION_MAX_QUBITS = 2
+
+# minimum number of gates a group of pending gates needs to be fused
+# into a dense gate, which costs 2-3 general single-qubit passes over
+# the state (and diagonal and controlled gates are cheaper than that)
+DENSE_FUSION_MIN_GATES = 8
+
+# states with more qubits than this apply multi-qubit gates with
+# the numba kernels (when available) rather than with einsum
+EINSUM_MAX_QUBITS = 20
+
+# states with at least this many qubits are kept on the GPU when cupy
+# is installed; below it kernel launch overhead outweighs the gain
+GPU_MIN_QUBITS = 20
+
+# states reaching this many qubits with only Clifford gates applied are
+# kept as stabilizer tableaus; for random H/CNOT gates the tableau only
+# beats the state vector from 21 qubits, and from 22 qubits even when it
+# has to be converted back for a later non-Clifford gate
+STABILIZER_MIN_QUBITS = 22
+
+# number of logged Clifford gates at which logging stops, so that the
+# log of a state that stays small doesn't grow without bound
+MAX_CLIFFORD_LOG = 10000
 
 
 # defining some helper types
@@ -17,6 +58,150 @@ Bit = bool
 Register = int
 
 
+def _gate_matrix(U: np.ndarray, dtype) -> np.ndarray:
+    """ Read-only copy of a gate matrix in the given precision """
+    U = np.array(U, dtype=dtype)
+    U.setflags(write=False)
+    return U
+
+
+def _rz_matrix(r: float, dtype) -> np.ndarray:
+    # same as RZGate(r).to_matrix(), without building a Qiskit gate
+    return _diag_matrix(-r / 2, r / 2, dtype)
+
+
+@lru_cache(maxsize=1024)
+def _diag_matrix(a: float, b: float, dtype) -> np.ndarray:
+    return _gate_matrix(np.diag([np.exp(1j*a), np.exp(1j*b)]), dtype)
+
+
+def _apply_1q(state: np.ndarray, U: np.ndarray, t: int, ctrls: Tuple[int, ...] = (),
+              scratch: Optional[np.ndarray] = None):
+    """ Apply the 2x2 matrix U in place along axis t of a state tensor,
+    restricted to the block where all the ctrls axes are 1; temporaries
+    are taken from the flat `scratch` array (of at least the state's
+    size) if given """
+    if ctrls:
+        # controlled gates only act on a (strided) view of the state
+        idx = [slice(None)] * state.ndim
+        for c in ctrls:
+            idx[c] = 1
+        state = state[tuple(idx)]
+        t -= sum(c < t for c in ctrls)
+
+    a = state[(slice(None),) * t + (0, Ellipsis)]
+    b = state[(slice(None),) * t + (1, Ellipsis)]
+    if scratch is None:
+        scratch = np.empty(state.size, dtype=state.dtype)
+    tmp = scratch[:a.size].reshape(a.shape)
+
+    if U[0, 1] == 0 and U[1, 0] == 0:
+        # diagonal gates (Z, S, T, Rz, Diag, CZ, CRz) just rescale each half
+        if U[0, 0] != 1:
+            a *= U[0, 0]
+        if U[1, 1] != 1:
+            b *= U[1, 1]
+    elif U[0, 0] == 0 and U[1, 1] == 0:
+        # anti-diagonal gates (X, Y, CNOT, Toffoli, CY) swap the two halves
+        tmp[...] = a
+        a[...] = b
+        b[...] = tmp
+        if U[0, 1] != 1:
+            a *= U[0, 1]
+        if U[1, 0] != 1:
+            b *= U[1, 0]
+    elif U[0, 0] == U[0, 1] == U[1, 0] == -U[1, 1]:
+        # Hadamard: (a + b, a - b) / sqrt(2)
+        tmp[...] = a
+        tmp -= b
+        a += b
+        a *= U[0, 0]
+        tmp *= U[0, 0]
+        b[...] = tmp
+    else:
+        tmp2 = scratch[a.size:2 * a.size].reshape(a.shape)
+        tmp[...] = a
+        a *= U[0, 0]
+        tmp2[...] = b
+        tmp2 *= U[0, 1]
+        a += tmp2
+        b *= U[1, 1]
+        tmp *= U[1, 0]
+        b += tmp
+
+
+_EINSUM_LETTERS = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+
+@lru_cache(maxsize=1024)
+def _einsum_plan(shape: Tuple[int, ...], axes: Tuple[int, ...]):
+    """ einsum subscripts and contraction path for applying a gate
+    to the given axes of a state tensor with the given shape """
+    ndim, k = len(shape), len(axes)
+    state = _EINSUM_LETTERS[:ndim]
+    out = list(state)
+    for j, axis in enumerate(axes):
+        out[axis] = _EINSUM_LETTERS[ndim + j]
+    subscripts = '%s%s,%s->%s' % (_EINSUM_LETTERS[ndim:ndim + k],
+        ''.join(state[axis] for axis in axes), state, ''.join(out))
+
+    # only the shapes matter for planning, so zero-strided
+    # placeholders are used instead of real arrays
+    path, _ = np.einsum_path(subscripts, np.broadcast_to(0j, (2,) * 2 * k),
+        np.broadcast_to(0j, shape), optimize='optimal')
+    return subscripts, path
+
+
+def _apply_kq(state: np.ndarray, U: np.ndarray, axes: Tuple[int, ...],
+              out: Optional[np.ndarray] = None) -> np.ndarray:
+    """ Apply the 2^k x 2^k matrix U to the given axes of a state tensor
+    (axes[0] being the most significant qubit of U), writing the result
+    to `out` if given (NumPy only) """
+    subscripts, path = _einsum_plan(state.shape, axes)
+    U = U.reshape((2,) * 2 * len(axes))
+    if isinstance(state, np.ndarray):
+        if out is not None:
+            return np.einsum(subscripts, U, state, optimize=path, out=out)
+        return np.ascontiguousarray(np.einsum(subscripts, U, state, optimize=path))
+    else:
+        return cp.ascontiguousarray(cp.einsum(subscripts, cp.asarray(U), state))
+
+
+def _dense_matrix(gate, qubits: Tuple[Qubit, ...]) -> np.ndarray:
+    """ Matrix of a pending gate over the given qubits
+    (qubits[0] being the most significant) """
+    targets, ctrls, U = gate
+    k = len(qubits)
+    M = np.eye(2 ** k, dtype=U.dtype).reshape((2,) * k + (2 ** k,))
+    axes = tuple(qubits.index(q) for q in targets)
+    if len(axes) == 1:
+        _apply_1q(M, U, axes[0], tuple(qubits.index(c) for c in ctrls))
+    else:
+        M = _apply_kq(M, U, axes)
+    return M.reshape(2 ** k, 2 ** k)
+
+
+# gates accepted by `run_batch`, as the number of parameters
+# they take and a function building the Qiskit gate
+_BATCH_GATES: Dict[str, Tuple[int, Callable[..., Gate]]] = {
+    'H': (0, HGate),
+    'X': (0, XGate),
+    'Y': (0, YGate),
+    'Z': (0, ZGate),
+    'T': (0, TGate),
+    'TInv': (0, TdgGate),
+    'S': (0, SGate),
+    'SInv': (0, SdgGate),
+    'CNOT': (0, CXGate),
+    'Toffoli': (0, CCXGate),
+    'Rz': (1, RZGate),
+    'Diag': (2, lambda a, b: DiagonalGate([np.exp(1j*a), np.exp(1j*b)])),
+    'CZ': (0, CZGate),
+    'CY': (0, CYGate),
+    'CRz': (1, CRZGate),
+}
+
+
 @dataclass
 class QubitRegister:
     qubit: int
@@ -31,10 +216,40 @@ class BitRegister:
 
 
 class QiskitSimulator(Simulator):
-    def __init__(self):
+    def __init__(self, precision: str = 'single', fusion_max_qubit: int = 5,
+                 fusion_threshold: int = 5, threads: int = 0):
+        """ `precision` is 'single' or 'double'; the other options
+        configure the AerSimulator used by `run_batch` and `run_qasm3`:
+        gates are fused into blocks of up to `fusion_max_qubit` qubits
+        in circuits with at least `fusion_threshold` qubits, and Aer
+        uses `threads` threads (0 for all cores; 1 is sometimes faster
+        for small states, where threading overhead dominates) """
         super(QiskitSimulator, self).__init__()
+        # single precision halves the memory traffic of every gate,
+        # use 'double' if the extra accuracy is needed
+        match precision:
+            case 'single':
+                self.dtype = np.complex64
+            case 'double':
+                self.dtype = np.complex128
+            case _:
+                raise Exception('Invalid precision `%s`' % precision)
+
+        # building the fixed gate matrices once
+        self._H = _gate_matrix(HGate().to_matrix(), self.dtype)
+        self._X = _gate_matrix(XGate().to_matrix(), self.dtype)
+        self._Y = _gate_matrix(YGate().to_matrix(), self.dtype)
+        self._Z = _gate_matrix(ZGate().to_matrix(), self.dtype)
+        self._T = _gate_matrix(TGate().to_matrix(), self.dtype)
+        self._TInv = _gate_matrix(TGate().inverse().to_matrix(), self.dtype)
+        self._S = _gate_matrix(SGate().to_matrix(), self.dtype)
+        self._SInv = _gate_matrix(SGate().inverse().to_matrix(), self.dtype)
+
         self.reset()
-        self._sim = AerSimulator()
+        self._sim = AerSimulator(method='statevector', precision=precision,
+                                 fusion_enable=True, fusion_threshold=fusion_threshold,
+                                 fusion_max_qubit=fusion_max_qubit,
+                                 max_parallel_threads=threads)
 
     def _check_qubit_reg_exists(self, reg: Register):
         if reg not in self.context:
@@ -57,19 +272,168 @@ class QiskitSimulator(Simulator):
         self.num_qubits = 0
         self.context: Dict[Register, Union[QubitRegister, BitRegister]] = dict()
 
-        self.state = None
+        # state vector reshaped to (2,)*num_qubits, with qubit k
+        # along axis num_qubits-1-k (so that flattening it gives
+        # Qiskit's little-endian ordering); measured qubits keep
+        # their axis with size 1 until it is reused
+        self.state: Optional[np.ndarray] = None
+
+        # array module holding the state, cupy once
+        # the state is large enough to be worth moving to the GPU
+        self._xp = np
+
+        # flat scratch buffer reused by the gates (see `_spare`)
+        self._spare_buf: Optional[np.ndarray] = None
+
+        # while only Clifford gates have been applied, states with at least
+        # STABILIZER_MIN_QUBITS qubits are kept as a stabilizer tableau
+        # instead (and `self.state` is None); qubit k of the tableau is
+        # qubit k of the simulator
+        self._stabilizer: Optional[StabilizerState] = None
+
+        # Clifford gates applied to the state vector since it was created,
+        # as (gate, qubits), used to build the tableau once the state is
+        # large enough; None once a non-Clifford gate or a measurement
+        # has been applied
+        self._clifford_log: Optional[List[Tuple[Gate, List[Qubit]]]] = []
+
+        # qubit indices freed by measurement, reused before
+        # allocating new ones so qubits never have to be renumbered
+        self._free_qubits: List[Qubit] = []
+
+        # gates not yet applied to the state vector, as (target qubits,
+        # control qubits, matrix over the targets); only gates with a
+        # single target have controls
+        self._pending: List[Tuple[Tuple[Qubit, ...], Tuple[Qubit, ...], Optional[np.ndarray]]] = []
+
+        # gates grouped into a pending entry (whose matrix is None) until
+        # there are enough of them to be worth fusing into a dense gate
+        self._groups: Dict[int, list] = dict()
+
+        # index of the last pending gate acting on each qubit
+        self._last_pending: Dict[Qubit, int] = dict()
+
+    def _flush(self):
+        """ Apply all pending gates to the state vector """
+        for i, (targets, ctrls, U) in enumerate(self._pending):
+            if i in self._groups:
+                for gate in self._groups[i]:
+                    self._apply_gate(*gate)
+            else:
+                self._apply_gate(targets, ctrls, U)
+        self._pending.clear()
+        self._groups.clear()
+        self._last_pending.clear()
+
+    def _leave_stabilizer(self):
+        """ Switch from the stabilizer tableau to the state vector, applying
+        a circuit preparing the tableau's state on the live qubits to
+        |0...0> with the gate kernels """
+        # freed qubits are kept in |0>, so no stabilizer has an X or Y on
+        # them and dropping them from the stabilizers leaves (redundant)
+        # stabilizers of the live qubits; the state vector then never
+        # has to include the freed qubits
+        free = set(self._free_qubits)
+        live = [q for q in range(self.num_qubits) if q not in free]
+        stabilizers = []
+        for label in self._stabilizer.clifford.to_labels(mode='S'):
+            # (labels are the sign followed by the highest qubit first)
+            paulis = label[:0:-1]
+            stabilizers.append(label[0] + ''.join(paulis[q] for q in reversed(live)))
+        circuit = synth_circuit_from_stabilizers(stabilizers, allow_redundant=True)
+
+        self._stabilizer = None
+        self._xp = np
+        shape = tuple(1 if self.num_qubits - 1 - a in free else 2 for a in range(self.num_qubits))
+        self.state = np.zeros(shape, dtype=self.dtype)
+        self.state[(0,) * self.num_qubits] = 1
+
+        # (the synthesized circuits only use H, X, S, S*, CNOT and swap gates)
+        matrices = {'h': self._H, 'x': self._X, 's': self._S, 'sdg': self._SInv}
+        for instruction in circuit.data:
+            name = instruction.operation.name
+            qubits = tuple(live[circuit.find_bit(q).index] for q in instruction.qubits)
+            if name in matrices:
+                self._apply_gate(qubits, (), matrices[name])
+            elif name == 'cx':
+                self._apply_gate(qubits[1:], qubits[:1], self._X)
+            elif name == 'swap':
+                a, b = qubits
+                for c, t in ((a, b), (b, a), (a, b)):
+                    self._apply_gate((t,), (c,), self._X)
+            else:
+                raise Exception('Unexpected gate `%s` in stabilizer circuit' % name)
+
+        self._place_state()
+
+    def _place_state(self):
+        """ Move the state vector to the GPU once it has GPU_MIN_QUBITS
+        qubits, and back to main memory when it drops below that """
+        if cp is None or self.state is None:
+            return
+        xp = self._xp
+        if self.num_qubits - len(self._free_qubits) >= GPU_MIN_QUBITS:
+            self._xp = cp
+            self.state = cp.asarray(self.state)
+        else:
+            self._xp = np
+            self.state = cp.asnumpy(self.state)
+        if self._xp is not xp:
+            self._spare_buf = None
+
+    def _spare(self) -> np.ndarray:
+        """ Flat scratch buffer with at least as many entries as the
+        state, kept between gates so that they don't have to allocate
+        state-sized temporaries (at the cost of keeping a second state's
+        worth of memory allocated until the state shrinks) """
+        if self._spare_buf is None or self._spare_buf.size < self.state.size:
+            self._spare_buf = self._xp.empty(self.state.size, dtype=self.dtype)
+        return self._spare_buf
+
+    def _aer_state(self) -> np.ndarray:
+        """ State vector in the form expected by `set_statevector`
+        (double precision, normalized to within its tolerance) """
+        state = self.state.ravel().astype(np.complex128)
+        if self._xp is not np:
+            state = cp.asnumpy(state)
+        return state / np.linalg.norm(state)
+
+    def _axis(self, qubit: Qubit) -> int:
+        """ Axis of the state tensor corresponding to a qubit """
+        return self.num_qubits - 1 - qubit
+
+    def _mask(self, axis: int) -> int:
+        """ Bit of the flattened state index selecting an axis (of size
+        2, as the strides of size 1 axes are arbitrary), read off the
+        strides of the C-contiguous state """
+        return self.state.strides[axis] // self.state.itemsize
+
+    def _aer_qubit(self, qubit: Qubit) -> int:
+        """ Index of a qubit in the state vector without freed qubits """
+        return qubit - sum(1 for k in self._free_qubits if k < qubit)
 
     def dump(self) -> str:
         """ Dump the entire simulator state to the console """
+        self._flush()
+
         context = ''
         for key in self.context:
             val = self.context[key]
             context += '\n%d: %s' % (key, val)
 
-        if self.state == None:
+        state = self.state
+        if self._stabilizer is not None:
+            # printing the state vector of the tableau, then going back to
+            # the tableau so that dumping doesn't slow down later gates
+            stabilizer = self._stabilizer
+            self._leave_stabilizer()
+            state = self.state
+            self.state, self._stabilizer, self._spare_buf = None, stabilizer, None
+
+        if state is None:
             return context + '\n\n'
         else:
-            return context + '\nStatevector: ' + str(self.state.data) + '\n\n'
+            return context + '\nStatevector: ' + str(state.ravel()) + '\n\n'
 
     def fresh(self) -> Register:
         """ Finds the first unused register """
@@ -85,55 +449,125 @@ class QiskitSimulator(Simulator):
         if reg in self.context:
             raise UsageError('Register %d already exists' % reg)
         
-        self.num_qubits += 1
-        if self.state == None:
-            # if state is none, just create the state vector manually
-            if bvalue:
-                self.state = Statevector([0, 1])
-            else:
-                self.state = Statevector([1, 0])
+        if self._stabilizer is not None:
+            self._new_stabilizer_qubit(reg, bvalue)
+            return
+
+        value = self._xp.array([0, 1] if bvalue else [1, 0], dtype=self.dtype)
+        if self.state is None:
+            qubit = 0
+            self.state = value
+            self.num_qubits = 1
+        elif self._free_qubits:
+            # reusing a freed qubit by expanding its size 1 axis
+            qubit = self._free_qubits.pop()
+            t = self._axis(qubit)
+            self.state = self.state * value.reshape((2,) + (1,) * (self.num_qubits - 1 - t))
         else:
-            # creating a circuit to process adding qubit to statevector
-            qc = QuantumCircuit(self.num_qubits)
-            qc.initialize(self.state, list(range(self.num_qubits-1)))
+            # a new qubit is the highest one, i.e. the first axis of
+            # the state, so the new state is just |b> (x) state
+            qubit = self.num_qubits
+            self.state = value.reshape((2,) + (1,) * self.num_qubits) * self.state
+            self.num_qubits += 1
+        
+        self.context[reg] = QubitRegister(qubit)
+
+        if self._clifford_log is not None:
             if bvalue:
-                qc.x(self.num_qubits-1)
-            qc.save_statevector()
+                self._clifford_log.append((XGate(), [qubit]))
+            if self.num_qubits - len(self._free_qubits) >= STABILIZER_MIN_QUBITS:
+                self._enter_stabilizer()
+                return
+        self._place_state()
+
+    def _enter_stabilizer(self):
+        """ Switch from the state vector to a stabilizer tableau, built
+        from the logged Clifford gates """
+        circuit = QuantumCircuit(self.num_qubits)
+        for gate, qubits in self._clifford_log:
+            circuit.append(gate, qubits)
+        self._stabilizer = StabilizerState(circuit)
+        self._clifford_log = None
+
+        # the pending gates are in the log as well
+        self._pending.clear()
+        self._groups.clear()
+        self._last_pending.clear()
+        self.state = None
+        self._spare_buf = None
 
-            # running circuit
-            self.state = self._sim.run(qc,shots=1).result().get_statevector()
-        
-        self.context[reg] = QubitRegister(self.num_qubits-1)
+    def new_bit(self, reg: Register, bvalue: Bit = False):
+        # making sure register is empty
+        if reg in self.context:
+            raise UsageError('Register %d already exists' % reg)
+
+        # creating a new bit
+        self.context[reg] = BitRegister(bvalue)
+
+    def _new_stabilizer_qubit(self, reg: Register, bvalue: Bit):
+        if self._free_qubits:
+            # freed qubits are already in |0>
+            qubit = self._free_qubits.pop()
+        else:
+            qubit = self.num_qubits
+            self._stabilizer = self._stabilizer.expand(StabilizerState(QuantumCircuit(1)))
+            self.num_qubits += 1
+
+        if bvalue:
+            self._stabilizer = self._stabilizer.evolve(XGate(), [qubit])
+        self.context[reg] = QubitRegister(qubit)
 
     def measure(self, reg: Register):
         # making sure register exists and is type qubit
         self._check_qubit_reg_exists(reg)
         q_reg = self.context[reg]
+        qubit = q_reg.qubit
+        n = self.num_qubits - len(self._free_qubits)
 
-        # using simulator to apply measurement operation
-        qc = QuantumCircuit(self.num_qubits, 1)
-        qc.initialize(self.state, list(range(self.num_qubits)))
-        qc.measure(q_reg.qubit, 0)
-        qc.save_statevector()
+        if self._stabilizer is not None:
+            outcome, self._stabilizer = self._stabilizer.measure([qubit])
+            meas_result: Bit = outcome == '1'
 
-        result = self._sim.run(qc,shots=1).result()
-        meas_result: Bit = bool(int(list(result.get_counts())[0]))
+            # freed qubits are kept in |0>
+            if meas_result:
+                self._stabilizer = self._stabilizer.evolve(XGate(), [qubit])
+        else:
+            self._flush()
+            self._clifford_log = None
+
+            # sampling the outcome from the marginal of the measured qubit
+            # (relative to the total norm, which drifts slightly in single
+            # precision)
+            t = self._axis(qubit)
+            idx = (slice(None),) * t
+            p = [float(self._xp.vdot(half, half).real)
+                 for half in (self.state[idx + (0,)], self.state[idx + (1,)])]
+            meas_result: Bit = bool(np.random.random() * (p[0] + p[1]) < p[1])
+
+            # projecting onto the outcome by slicing the measured
+            # qubit's axis down to size 1, then renormalizing
+            m = int(meas_result)
+            state = self.state[idx + (slice(m, m + 1),)]
+            self.state = self._xp.ascontiguousarray(state / np.sqrt(p[m]))
+
+            # releasing the spare buffer, which is now twice the size it
+            # needs to be (the next gate allocates one of the right size)
+            self._spare_buf = None
 
         # converting type of register to bit
         self.context[reg] = BitRegister(meas_result)
 
-        self.num_qubits -= 1
-        if self.num_qubits > 0:
-            self.state = partial_trace(result.get_statevector(), [q_reg.qubit]).to_statevector()
+        if n > 1:
+            self._free_qubits.append(qubit)
+            self._place_state()
         else:
+            self.num_qubits = 0
             self.state = None
+            self._spare_buf = None
+            self._stabilizer = None
+            self._clifford_log = []
+            self._free_qubits.clear()
 
-        # shuffling qubit indexes around to close the gap
-        for key in self.context:
-            x = self.context[key]
-            if isinstance(x, QubitRegister) and x.qubit > q_reg.qubit:
-                x.qubit -= 1
-                        
     def read(self, reg: Register) -> int:
         # making sure register exists
         if reg not in self.context:
@@ -165,69 +599,248 @@ class QiskitSimulator(Simulator):
         self._check_bit_reg_exists(reg)
 
         # removing bit register from context
-        del self.context[reg]
+        b_reg = self.context.pop(reg)
         
         # creating new qubit register
         self.new_qubit(reg, b_reg.bit)
 
-    def _gate_operation(self, gate, regs: List[Register], controls: List[Register]):
-        for x in regs:
-            self._check_qubit_reg_exists(x)
+    def _check_gate(self, regs: List[Register], controls: List[Register]) -> bool:
+        """ Check the registers of a gate, returning False if the
+        gate is disabled by one of its classical controls """
+        # checking the classical controls first, so that disabled
+        # gates return before doing any other work
         for c in controls:
             self._check_bit_reg_exists(c)
             c_reg = self.context[c]
             if not c_reg.bit:
-                return
-        
+                return False
+        for x in regs:
+            self._check_qubit_reg_exists(x)
+        return True
+
+    def _apply_gate(self, targets: Tuple[Qubit, ...], ctrls: Tuple[Qubit, ...], U: np.ndarray):
+        """ Apply a gate to the state vector """
+        axes = tuple(self._axis(q) for q in targets)
+        ctrl_axes = tuple(self._axis(c) for c in ctrls)
+
+        use_numba = _kernels.HAVE_NUMBA and self._xp is np
+        if use_numba and (len(axes) == 1 or self.state.size > 1 << EINSUM_MAX_QUBITS):
+            # the state is always C-contiguous, so this is a view
+            state = self.state.reshape(-1)
+            cmask = sum(self._mask(c) for c in ctrl_axes)
+            if len(axes) == 1:
+                _kernels.apply_1q(state, U, self._mask(axes[0]), cmask)
+            else:
+                _kernels.apply_kq(state, U, [self._mask(a) for a in axes], cmask)
+        elif len(axes) == 1:
+            # (these work on both NumPy and CuPy arrays)
+            _apply_1q(self.state, U, axes[0], ctrl_axes, self._spare())
+        elif self._xp is np:
+            # writing the result to the spare buffer and
+            # keeping the old state as the next spare buffer
+            out = self._spare()[:self.state.size].reshape(self.state.shape)
+            out = _apply_kq(self.state, U, axes, out=out)
+            self._spare_buf, self.state = self.state.reshape(-1), out
+        else:
+            self.state = _apply_kq(self.state, U, axes)
+
+    def _gate_operation(self, U: np.ndarray, regs: List[Register], controls: List[Register],
+                        clifford: Optional[Gate] = None):
+        """ Apply the single-qubit gate U to the last register in regs,
+        with the other registers in regs as quantum controls; `clifford`
+        is the whole gate if it is a Clifford gate """
+        if not self._check_gate(regs, controls):
+            return
+        if len(set(regs)) != len(regs):
+            raise UsageError('Gate registers must be distinct')
+
         qubits = [self.context[x].qubit for x in regs]
-        qc = QuantumCircuit(self.num_qubits)
-        qc.initialize(self.state, list(range(self.num_qubits)))
-        qc.append(gate, qubits)
-        qc.save_statevector()
-        result = self._sim.run(qc,shots=1).result()
-        self.state = result.get_statevector()
+        if self._stabilizer is not None:
+            if clifford is not None:
+                self._stabilizer = self._stabilizer.evolve(clifford, qubits)
+                return
+            self._leave_stabilizer()
+        elif self._clifford_log is not None:
+            if clifford is not None and len(self._clifford_log) < MAX_CLIFFORD_LOG:
+                self._clifford_log.append((clifford, qubits))
+            else:
+                self._clifford_log = None
+
+        gate = ((qubits[-1],), tuple(sorted(qubits[:-1])), np.asarray(U, dtype=self.dtype))
+
+        # queueing the gate; gates on other qubits commute with it, so it
+        # can be fused with the last pending gate acting on any of its
+        # qubits, either directly if that gate has the same targets and
+        # controls, or as a dense matrix if together they act on at most
+        # FUSION_MAX_QUBITS qubits
+        i = max(self._last_pending.get(q, -1) for q in qubits)
+        if i >= 0:
+            targets, ctrls, U = self._pending[i]
+            union = tuple(sorted(set(targets + ctrls + tuple(qubits))))
+            if (targets, ctrls) == gate[:2]:
+                self._pending[i] = (targets, ctrls, gate[2] @ U)
+                return
+            elif len(union) <= FUSION_MAX_QUBITS:
+                if i not in self._groups and len(targets) > 1:
+                    # already a dense gate
+                    self._pending[i] = (union, (), _dense_matrix(gate, union) @
+                                        _dense_matrix(self._pending[i], union))
+                else:
+                    self._group_gate(i, gate, union)
+                for q in qubits:
+                    self._last_pending[q] = i
+                return
+
+        self._pending.append(gate)
+        for q in qubits:
+            self._last_pending[q] = len(self._pending) - 1
+        if len(self._pending) >= MAX_PENDING_GATES:
+            self._flush()
+
+    def _group_gate(self, i: int, gate, union: Tuple[Qubit, ...]):
+        """ Add a gate to the group of pending gates at index i, fusing
+        the group into a dense gate once it has DENSE_FUSION_MIN_GATES
+        gates (until then each gate costs its own pass) """
+        group = self._groups.setdefault(i, [self._pending[i]])
+        if group[-1][:2] == gate[:2]:
+            group[-1] = (gate[0], gate[1], gate[2] @ group[-1][2])
+        else:
+            group.append(gate)
+
+        if len(group) >= DENSE_FUSION_MIN_GATES:
+            U = _dense_matrix(group[0], union)
+            for g in group[1:]:
+                U = _dense_matrix(g, union) @ U
+            self._pending[i] = (union, (), U)
+            del self._groups[i]
+        else:
+            self._pending[i] = (union, (), None)
 
     def gate_H(self, reg: Register, controls: List[Register]):
-        self._gate_operation(HGate(), [reg], controls)
+        self._gate_operation(self._H, [reg], controls, HGate())
 
     def gate_X(self, reg: Register, controls: List[Register]):
-        self._gate_operation(XGate(), [reg], controls)
+        self._gate_operation(self._X, [reg], controls, XGate())
 
     def gate_Y(self, reg: Register, controls: List[Register]):
-        self._gate_operation(YGate(), [reg], controls)
+        self._gate_operation(self._Y, [reg], controls, YGate())
 
     def gate_Z(self, reg: Register, controls: List[Register]):
-        self._gate_operation(ZGate(), [reg], controls)
+        self._gate_operation(self._Z, [reg], controls, ZGate())
 
     def gate_T(self, reg: Register, controls: List[Register]):
-        self._gate_operation(TGate(), [reg], controls)
+        self._gate_operation(self._T, [reg], controls)
 
     def gate_TInv(self, reg: Register, controls: List[Register]):
-        self._gate_operation(TGate().inverse(), [reg], controls)
+        self._gate_operation(self._TInv, [reg], controls)
 
     def gate_S(self, reg: Register, controls: List[Register]):
-        self._gate_operation(SGate(), [reg], controls)
+        self._gate_operation(self._S, [reg], controls, SGate())
 
     def gate_SInv(self, reg: Register, controls: List[Register]):
-        self._gate_operation(SGate().inverse(), [reg], controls)
+        self._gate_operation(self._SInv, [reg], controls, SdgGate())
 
     def gate_CNOT(self, x: Register, y: Register, controls: List[Register]):
-        self._gate_operation(CXGate(), [x, y], controls)
+        self._gate_operation(self._X, [x, y], controls, CXGate())
 
     def gate_Toffoli(self, x: Register, y: Register, z: Register, controls: List[Register]):
-        self._gate_operation(CCXGate(), [x, y, z], controls)
+        self._gate_operation(self._X, [x, y, z], controls)
     
     def gate_Rz(self, r: float, reg: Register, controls: List[Register]):
-        self._gate_operation(RZGate(r), [reg], controls)
+        self._gate_operation(_rz_matrix(r, self.dtype), [reg], controls)
 
     def gate_Diag(self, a: float, b: float, reg: Register, controls: List[Register]):
-        self._gate_operation(DiagonalGate([np.exp(1j*a), np.exp(1j*b)]), [reg], controls)
+        self._gate_operation(_diag_matrix(a, b, self.dtype), [reg], controls)
 
     def gate_CZ(self, x: Register, y: Register, controls: List[Register]):
-        self._gate_operation(ZGate().control(), [x, y], controls)
+        self._gate_operation(self._Z, [x, y], controls, CZGate())
 
     def gate_CY(self, x: Register, y: Register, controls: List[Register]):
-        self._gate_operation(YGate().control(), [x, y], controls)
+        self._gate_operation(self._Y, [x, y], controls, CYGate())
     
     def gate_CRz(self, r: float, x: Register, y: Register, controls: List[Register]):
-        self._gate_operation(RZGate(r).control(), [x, y], controls)
\ No newline at end of file
+        self._gate_operation(_rz_matrix(r, self.dtype), [x, y], controls)
+
+    def run_batch(self, ops: List[Tuple]):
+        """ Apply a sequence of gates in a single Aer run, each given as
+        a tuple of the gate's name (as in the gate_* methods) followed
+        by its parameters and registers, e.g. ('CRz', 0.5, x, y) """
+        gates = []
+        regs: List[Register] = []
+        for op in ops:
+            if not op or op[0] not in _BATCH_GATES:
+                raise UsageError('Unknown gate `%s`' % (op[0] if op else ''))
+            num_params, make_gate = _BATCH_GATES[op[0]]
+            if len(op) <= num_params:
+                raise UsageError('Gate %s takes %d parameters' % (op[0], num_params))
+            gate = make_gate(*op[1:1 + num_params])
+            gate_regs = list(op[1 + num_params:])
+            if len(gate_regs) != gate.num_qubits:
+                raise UsageError('Gate %s takes %d registers' % (op[0], gate.num_qubits))
+            if len(set(gate_regs)) != len(gate_regs):
+                raise UsageError('Gate registers must be distinct')
+            regs.extend(x for x in gate_regs if x not in regs)
+            gates.append((gate, gate_regs))
+
+        # qubit j of the circuit is register regs[j]
+        circuit = QuantumCircuit(len(regs))
+        for gate, gate_regs in gates:
+            circuit.append(gate, [regs.index(x) for x in gate_regs])
+        self._run_circuit(circuit, regs)
+
+    def run_qasm3(self, src: str, regs: List[Register]):
+        """ Apply an OpenQASM 3 program containing only gates in a
+        single Aer run, with the program's qubit j being register regs[j] """
+        try:
+            circuit = qasm3.loads(src)
+        except MissingOptionalLibraryError:
+            raise UsageError('Running OpenQASM 3 programs needs the qasm3 extra '
+                             '(qiskit-qasm3-import) to be installed')
+        if circuit.num_qubits != len(regs):
+            raise UsageError('Program has %d qubits but %d registers were given'
+                             % (circuit.num_qubits, len(regs)))
+        if circuit.num_clbits:
+            raise UsageError('Program must not use classical bits')
+        self._run_circuit(circuit, regs)
+
+    def _run_circuit(self, circuit: QuantumCircuit, regs: List[Register]):
+        """ Apply a circuit with Aer, qubit j of the circuit acting on
+        register regs[j] """
+        for x in regs:
+            self._check_qubit_reg_exists(x)
+        if len(set(regs)) != len(regs):
+            raise UsageError('Gate registers must be distinct')
+        if not regs:
+            return
+
+        if self._stabilizer is not None:
+            self._leave_stabilizer()
+        self._flush()
+        self._clifford_log = None
+
+        # running the whole circuit on a copy of the state, so that
+        # Aer's transpiler and gate fusion see all of it at once
+        n = self.num_qubits - len(self._free_qubits)
+        qc = QuantumCircuit(n)
+        qc.set_statevector(self._aer_state())
+        qc.compose(circuit, qubits=[self._aer_qubit(self.context[x].qubit) for x in regs],
+                   inplace=True)
+        qc.save_statevector()
+        qc = transpile(qc, self._sim, optimization_level=3)
+
+        # Aer drops the global phase of circuits starting with
+        # set_statevector, so it is applied to the result instead
+        phase = np.exp(1j * float(qc.global_phase))
+        qc.global_phase = 0
+        result = self._sim.run(qc, shots=1).result()
+
+        # the transpiler may drop swaps by relabelling the qubits after
+        # them, so qubit j ends up on qubit final_index_layout()[j]
+        state = np.asarray(result.get_statevector()).reshape((2,) * n) * phase
+        if qc.layout is not None:
+            perm = qc.layout.final_index_layout()
+            state = state.transpose([n - 1 - perm[n - 1 - a] for a in range(n)])
+
+        # freed qubits have size 1 axes, so the state
+        # has the same layout as Aer's state vector
+        self.state = self._xp.asarray(state.reshape(self.state.shape).astype(self.dtype))
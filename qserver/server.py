@@ -8,12 +8,14 @@ from .simulator import UsageError
 
 
 class Server:
-    def __init__(self, port: int, max_conns: int, verbose: bool = False, sim_method: str = 'cirq'):
+    def __init__(self, port: int, max_conns: int, verbose: bool = False, sim_method: str = 'cirq',
+                 precision: str = 'single'):
         self.port = port
         self.max_conns = max_conns
         self.verbose = verbose
         self.num_conns = 0
         self.sim_method = sim_method
+        self.precision = precision
 
     def run(self):
         # setting up socket connection
@@ -55,7 +57,7 @@ class Server:
                     sim_mode = connFile.readline().strip()
 
                 # parsing commands line by line
-                interpreter = Interpreter(sim_method=self.sim_method)
+                interpreter = Interpreter(sim_method=self.sim_method, precision=self.precision)
                 while True:
                     # reading the next line
                     line = connFile.readline()
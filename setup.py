@@ -14,5 +14,10 @@ setup(
         'cirq>=1.5.0',
         'qiskit>=2.1.1',
         'qiskit-aer>=0.17.1',
-    ]
+    ],
+    extras_require={
+        'numba': ['numba>=0.60'],
+        'gpu': ['cupy-cuda12x'],
+        'qasm3': ['qiskit-qasm3-import>=0.5'],
+    }
 )
\ No newline at end of file
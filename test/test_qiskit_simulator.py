@@ -0,0 +1,245 @@
+import pytest
+import numpy as np
+from qiskit import QuantumCircuit
+from qiskit.quantum_info import Statevector
+from qiskit.circuit.library import DiagonalGate
+
+from qserver.qiskit_simulator import QiskitSimulator
+from qserver.simulator import UsageError
+
+TOLERANCE = {'single': 1e-5, 'double': 1e-12}
+
+# gates of the simulator as (number of parameters, number of
+# registers, function adding the gate to a reference circuit)
+GATES = {
+    'H': (0, 1, lambda qc, q: qc.h(*q)),
+    'X': (0, 1, lambda qc, q: qc.x(*q)),
+    'Y': (0, 1, lambda qc, q: qc.y(*q)),
+    'Z': (0, 1, lambda qc, q: qc.z(*q)),
+    'T': (0, 1, lambda qc, q: qc.t(*q)),
+    'TInv': (0, 1, lambda qc, q: qc.tdg(*q)),
+    'S': (0, 1, lambda qc, q: qc.s(*q)),
+    'SInv': (0, 1, lambda qc, q: qc.sdg(*q)),
+    'CNOT': (0, 2, lambda qc, q: qc.cx(*q)),
+    'Toffoli': (0, 3, lambda qc, q: qc.ccx(*q)),
+    'Rz': (1, 1, lambda qc, r, q: qc.rz(r, q)),
+    'Diag': (2, 1, lambda qc, a, b, q: qc.append(DiagonalGate([np.exp(1j*a), np.exp(1j*b)]), [q])),
+    'CZ': (0, 2, lambda qc, q: qc.cz(*q)),
+    'CY': (0, 2, lambda qc, q: qc.cy(*q)),
+    'CRz': (1, 2, lambda qc, r, q: qc.crz(r, *q)),
+}
+
+
+def statevector(sim):
+    """Current state vector of a simulator, dumping it first
+    to apply any pending gates"""
+    sim.dump()
+    return np.asarray(sim.state).ravel()
+
+
+def random_ops(rng, qubits, num_ops):
+    """Random gates as (name, parameters, registers)"""
+    ops = []
+    for _ in range(num_ops):
+        name = rng.choice(list(GATES))
+        num_params, num_regs, _ = GATES[name]
+        params = list(rng.uniform(-np.pi, np.pi, num_params))
+        regs = [int(x) for x in rng.choice(qubits, num_regs, replace=False)]
+        ops.append((name, params, regs))
+    return ops
+
+
+def add_to_reference(qc, name, params, qubits):
+    """Add a gate to a reference circuit"""
+    _, _, add = GATES[name]
+    if params:
+        add(qc, *params, qubits if len(qubits) > 1 else qubits[0])
+    else:
+        add(qc, qubits)
+
+
+@pytest.mark.parametrize('precision', ['single', 'double'])
+def test_gates(precision):
+    """Testing all gates, with classical controls, against a reference state"""
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        sim = QiskitSimulator(precision)
+        qc = QuantumCircuit(5)
+        for q in range(5):
+            sim.new_qubit(q, q % 2 == 1)
+            if q % 2 == 1:
+                qc.x(q)
+
+        # bits to control the gates with, from measuring fresh qubits
+        sim.new_qubit(5, True)
+        sim.new_qubit(6)
+        assert (sim.read(5), sim.read(6)) == (1, 0)
+
+        for name, params, regs in random_ops(rng, range(5), 40):
+            controls = [int(x) for x in rng.choice([5, 6], rng.integers(0, 2))]
+            getattr(sim, 'gate_' + name)(*params, *regs, controls)
+            if 6 not in controls:
+                add_to_reference(qc, name, params, regs)
+
+        expected = Statevector(qc).data
+        assert np.allclose(statevector(sim), expected, atol=TOLERANCE[precision])
+
+
+def test_invalid_precision():
+    """Testing that only single and double precision are accepted"""
+    with pytest.raises(Exception):
+        QiskitSimulator('half')
+
+
+@pytest.mark.parametrize('precision', ['single', 'double'])
+def test_measure_and_reuse(precision):
+    """Testing measurement and reuse of measured qubits"""
+    for _ in range(10):
+        sim = QiskitSimulator(precision)
+        for q in range(3):
+            sim.new_qubit(q)
+        sim.gate_H(0, [])
+        sim.gate_CNOT(0, 1, [])
+        sim.gate_X(2, [])
+        sim.gate_T(0, [])
+
+        # deterministic outcome, then reusing the measured qubit
+        assert sim.read(2) == 1
+        sim.new_qubit(3)
+        sim.gate_H(3, [])
+        sim.gate_CNOT(3, 0, [])
+
+        qc = QuantumCircuit(3)
+        qc.h(0)
+        qc.cx(0, 1)
+        qc.t(0)
+        qc.h(2)
+        qc.cx(2, 0)
+        expected = Statevector(qc).data
+        assert np.allclose(statevector(sim), expected, atol=TOLERANCE[precision])
+
+        # entangled qubits give equal outcomes
+        sim.gate_CNOT(3, 0, [])
+        sim.discard(3)
+        assert sim.read(0) == sim.read(1)
+        assert sim.state is None
+
+
+def test_stabilizer_states():
+    """Testing states large enough to be kept as stabilizer tableaus"""
+    n = 24
+    sim = QiskitSimulator('double')
+    for q in range(n):
+        sim.new_qubit(q)
+    sim.gate_H(0, [])
+    for q in range(1, n):
+        sim.gate_CNOT(q - 1, q, [])
+
+    outcome = sim.read(n - 1)
+    assert all(sim.read(q) == outcome for q in range(3, n - 1))
+
+    # dumping the state doesn't leave the tableau
+    assert 'Statevector' in sim.dump()
+    assert sim.state is None
+
+    # leaving the tableau at the first non-Clifford gate, with
+    # only the qubits that weren't measured in the state vector
+    sim.gate_H(0, [])
+    sim.gate_CNOT(0, 1, [])
+    sim.gate_S(1, [])
+    sim.gate_T(2, [])
+    assert sim.state.size == 8
+
+    qc = QuantumCircuit(3)
+    if outcome:
+        qc.x([0, 1, 2])
+    qc.h(0)
+    qc.cx(0, 1)
+    qc.s(1)
+    qc.t(2)
+    fidelity = abs(np.vdot(Statevector(qc).data, statevector(sim)))
+    assert fidelity == pytest.approx(1)
+
+
+def test_registers():
+    """Testing bit registers and turning them into qubits"""
+    sim = QiskitSimulator()
+    sim.new_bit(3, True)
+    sim.new_qubit_from_bit(3)
+    assert sim.read(3) == 1
+
+    sim.new_bit(10 ** 9, True)
+    sim.new_qubit(-4)
+    sim.gate_X(-4, [10 ** 9])
+    assert sim.read(-4) == 1
+    assert sim.fresh() == 0
+
+    with pytest.raises(UsageError):
+        sim.new_bit(3)
+    with pytest.raises(UsageError):
+        sim.gate_H(3, [])
+    sim.discard(3)
+    with pytest.raises(UsageError):
+        sim.read(3)
+
+
+def test_run_batch():
+    """Testing batches of gates against single gates"""
+    rng = np.random.default_rng(2)
+    a = QiskitSimulator('double')
+    b = QiskitSimulator('double')
+    for sim in (a, b):
+        for q in range(4):
+            sim.new_qubit(q)
+            sim.gate_H(q, [])
+        sim.gate_T(0, [])
+
+    ops = random_ops(rng, range(4), 40)
+    for name, params, regs in ops:
+        getattr(a, 'gate_' + name)(*params, *regs, [])
+    b.run_batch([(name, *params, *regs) for name, params, regs in ops])
+    fidelity = abs(np.vdot(statevector(a), statevector(b)))
+    assert fidelity == pytest.approx(1)
+
+    for op in [('Rz',), ('CNOT', 0, 0), ('H', 9), ('Foo', 0)]:
+        with pytest.raises(UsageError):
+            b.run_batch([op])
+
+
+def test_run_circuit_with_swaps():
+    """Testing that swaps dropped by the transpiler are still applied"""
+    sim = QiskitSimulator('double')
+    for q in range(3):
+        sim.new_qubit(q, q == 0)
+    qc = QuantumCircuit(3)
+    qc.swap(0, 2)
+    qc.h(1)
+    sim._run_circuit(qc, [0, 1, 2])
+
+    expected = np.zeros(8)
+    expected[[4, 6]] = 1 / np.sqrt(2)
+    assert np.allclose(statevector(sim), expected)
+
+
+def test_run_qasm3():
+    """Testing OpenQASM 3 programs against a reference state"""
+    pytest.importorskip('qiskit_qasm3_import')
+    sim = QiskitSimulator('double')
+    sim.new_qubit(7, True)
+    sim.new_qubit(2)
+    sim.run_qasm3('''
+        OPENQASM 3.0;
+        include "stdgates.inc";
+        qubit[2] q;
+        h q[1];
+        swap q[0], q[1];
+        rz(0.3) q[1];
+    ''', [7, 2])
+
+    qc = QuantumCircuit(2)
+    qc.x(0)
+    qc.h(1)
+    qc.swap(0, 1)
+    qc.rz(0.3, 1)
+    fidelity = abs(np.vdot(Statevector(qc).data, statevector(sim)))
+    assert fidelity == pytest.approx(1)